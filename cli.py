@@ -1,13 +1,14 @@
 import rich_click as click  # Drop-in replacement for 'click'
-from rich.console import Console
-from rich.table import Table
-from rich.panel import Panel
+import logging
+import logging.handlers
+import multiprocessing
 import signal
+import sys
 
 from.db import init_db as _init_db
 from.persistence import SQLiteJobRepository
-from.core import WorkerConfig
-from.worker import Worker
+from.core import WorkerConfig, JITTER_STRATEGIES
+from.worker import Worker, OUTPUT_TAIL_BYTES
 
 # --- Rich-Click Configuration ---
 click.rich_click.STYLE_OPTION = "bold cyan"
@@ -16,6 +17,18 @@ click.rich_click.STYLE_COMMAND = "bold"
 click.rich_click.STYLE_METAVAR = "italic"
 # --- End Configuration ---
 
+# Above this many rows, 'list' skips Rich and writes plain text.
+PLAIN_TABLE_THRESHOLD = 200
+
+# Rich markup for each job state, looked up once per row/job.
+_STATE_MARKUP = {
+    'completed': "[green]completed[/green]",
+    'processing': "[yellow]processing[/yellow]",
+    'failed': "[orange]failed[/orange]",
+    'dead': "[bold red]dead[/bold red]",
+    'pending': "[dim]pending[/dim]",
+}
+
 @click.group()
 def main():
     """
@@ -30,7 +43,7 @@ def main():
 def initdb():
     """Initializes the job queue database."""
     _init_db()
-    console = Console()
+    console = _console()
     console.print("[bold green]Database initialized successfully.[/bold green]")
 
 @main.command()
@@ -42,43 +55,84 @@ def add(command, max_retries, priority, run_at):
     """Enqueues a new job to be processed."""
     repo = SQLiteJobRepository()
     job_id = repo.add(command, max_retries, priority, run_at)
-    console = Console()
+    console = _console()
     console.print(f"[bold green]Job enqueued with ID:[/bold green] {job_id}")
 
+@main.command("add-batch")
+@click.option("--file", "jobs_file", type=click.File("r"), required=True,
+              help="File with one command per line ('-' for stdin).")
+@click.option("--max-retries", type=int, default=3, help="Max retries before moving to DLQ.", show_default=True)
+@click.option("--priority", type=int, default=0, help="Job priority (higher is first).", show_default=True)
+@click.option("--run-at", type=str, help="Schedule jobs (ISO 8601 format: YYYY-MM-DDTHH:MM:SSZ).")
+def add_batch(jobs_file, max_retries, priority, run_at):
+    """Enqueues one job per non-empty line of a file, in a single transaction."""
+    commands = [line.strip() for line in jobs_file]
+    jobs = [(command, max_retries, priority, run_at) for command in commands if command]
+
+    repo = SQLiteJobRepository()
+    job_ids = repo.add_many(jobs)
+    console = _console()
+    console.print(f"[bold green]{len(job_ids)} job(s) enqueued.[/bold green]")
+
 @main.command()
 @click.option("--state", type=click.Choice(['pending', 'processing', 'completed', 'failed', 'dead']),
               default='pending', help="Filter by job state.", show_default=True)
 @click.option("--dlq", is_flag=True, help="Alias for --state dead.")
 @click.option("--limit", type=int, default=20, help="Number of jobs to show.", show_default=True)
-def list(state, dlq, limit):
+@click.option("--plain", is_flag=True, help=f"Plain-text output (always used above {PLAIN_TABLE_THRESHOLD} rows).")
+def list(state, dlq, limit, plain):
     """Lists jobs in the queue, color-coded by state."""
     repo = SQLiteJobRepository()
     if dlq:
         state = 'dead'
     
     jobs = repo.list_jobs(state=state, limit=limit)
-    _print_job_table(jobs, f"{state.title()} Jobs")
+    _print_job_table(jobs, f"{state.title()} Jobs", plain=plain)
 
 @main.command()
 @click.option("-n", "--workers", type=int, default=1, help="Number of worker processes to start.", show_default=True)
 @click.option("--backoff-base", type=int, default=2, help="Base for exponential backoff (base ^ attempts).", show_default=True)
-def worker(workers, backoff_base):
+@click.option("--jitter", type=click.Choice(JITTER_STRATEGIES), default="proportional",
+              help="Backoff jitter: +/- 20%, full (0..delay) or decorrelated.", show_default=True)
+@click.option("--concurrency", type=int, default=1, help="Jobs each worker process runs at once.", show_default=True)
+@click.option("--log-level", type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR'], case_sensitive=False),
+              default='WARNING', help="Worker log level (INFO also logs every job).", show_default=True)
+def worker(workers, backoff_base, jitter, concurrency, log_level):
     """Starts one or more worker processes to process jobs."""
     if workers <= 0:
         click.echo("Number of workers must be at least 1.", err=True)
         return
+    if concurrency <= 0:
+        click.echo("Concurrency must be at least 1.", err=True)
+        return
 
-    console = Console()
-    console.print(f"[bold]Starting {workers} worker process(es)...[/bold]")
-    console.print("Press [cyan]Ctrl+C[/cyan] to initiate graceful shutdown.")
-    
-    worker_config = WorkerConfig(backoff_base=backoff_base)
-    worker_processes =
+    # Fork workers from this already-initialised process (the default on
+    # Linux, but not on macOS), so they do not re-import the CLI.
+    multiprocessing.set_start_method("fork", force=True)
+
+    # Plain click output until the workers are forked: creating a Rich
+    # Console imports most of Rich, which the workers would inherit.
+    click.secho(f"Starting {workers} worker process(es)...", bold=True)
+    click.echo(f"Press {click.style('Ctrl+C', fg='cyan')} to initiate graceful shutdown.")
+
+    # Workers send log records over a queue; this process alone
+    # writes them to stdout. The listener thread is started only after
+    # the workers are forked (records wait in the queue until then).
+    log_queue = multiprocessing.Queue()
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+
+    worker_config = WorkerConfig(backoff_base=backoff_base, jitter=jitter)
+    worker_processes = []
     for _ in range(workers):
-        w = Worker(config=worker_config)
+        w = Worker(config=worker_config, concurrency=concurrency,
+                   log_queue=log_queue, log_level=log_level.upper())
         w.start()
         worker_processes.append(w)
 
+    log_listener.start()
+    console = _console()
+
     def shutdown_all_workers(sig, frame):
         console.print("\n[bold red]Shutdown signal received.[/bold red] Terminating workers...")
         for w in worker_processes:
@@ -94,12 +148,14 @@ def worker(workers, backoff_base):
     # Wait for all worker processes to exit
     for w in worker_processes:
         w.join()
+    log_listener.stop()
 
 @main.command()
 @click.argument("job_id", type=str)
 def show(job_id):
     """Shows detailed info for a single job, including stdout/stderr."""
-    console = Console()
+    from rich.panel import Panel
+    console = _console()
     repo = SQLiteJobRepository()
     job = repo.get(job_id)
     
@@ -107,13 +163,7 @@ def show(job_id):
         console.print(f"[bold red]Error:[/bold red] Job {job_id} not found.")
         return
 
-    # Helper to format state with color
-    state = job['state']
-    if state == 'completed': state = f"[green]{state}[/green]"
-    if state == 'processing': state = f"[yellow]{state}[/yellow]"
-    if state == 'failed': state = f"[orange]{state}[/orange]"
-    if state == 'dead': state = f"[bold red]{state}[/bold red]"
-    if state == 'pending': state = f"[dim]{state}[/dim]"
+    state = _STATE_MARKUP.get(job['state'], job['state'])
 
     content = f"""
 [bold]ID[/bold]:         {job['id']}
@@ -128,15 +178,17 @@ def show(job_id):
     console.print(Panel(content, title="Job Details", border_style="blue"))
     
     if job['stdout']:
-        console.print(Panel(job['stdout'], title="stdout", border_style="green"))
+        title = f"stdout (truncated to last {OUTPUT_TAIL_BYTES // 1024} KiB)" if job['stdout_truncated'] else "stdout"
+        console.print(Panel(job['stdout'], title=title, border_style="green"))
     if job['stderr']:
-        console.print(Panel(job['stderr'], title="stderr", border_style="red"))
+        title = f"stderr (truncated to last {OUTPUT_TAIL_BYTES // 1024} KiB)" if job['stderr_truncated'] else "stderr"
+        console.print(Panel(job['stderr'], title=title, border_style="red"))
 
 @main.command()
 @click.argument("job_id", type=str)
 def requeue(job_id):
     """Moves a 'dead' job from the DLQ back to 'pending'."""
-    console = Console()
+    console = _console()
     repo = SQLiteJobRepository()
     success = repo.requeue(job_id)
     if success:
@@ -144,11 +196,36 @@ def requeue(job_id):
     else:
         console.print(f"[bold red]Error:[/bold red] Job {job_id} not found or not in 'dead' state.")
 
+@main.command()
+@click.option("--older-than", type=int, default=7, help="Archive jobs last updated more than this many days ago.", show_default=True)
+def archive(older_than):
+    """Moves old 'completed' and 'dead' jobs to the archive table."""
+    if older_than < 0:
+        click.echo("--older-than must not be negative.", err=True)
+        return
+
+    repo = SQLiteJobRepository()
+    archived = repo.archive_old(older_than)
+    console = _console()
+    console.print(f"[bold green]{archived} job(s) archived.[/bold green]")
+
 # --- Helper Functions for Rich Output ---
+# Rich modules are imported where they are used, keeping them out of
+# CLI startup and out of the worker processes forked from it.
 
-def _print_job_table(jobs, title):
+def _console():
+    """Returns a new Rich Console, importing Rich on first use."""
+    from rich.console import Console
+    return Console()
+
+def _print_job_table(jobs, title, plain=False):
     """Renders a list of jobs in a Rich table. [124, 125, 126, 127, 12, 128, 129, 130]"""
-    console = Console()
+    if plain or len(jobs) > PLAIN_TABLE_THRESHOLD:
+        _write_plain_table(jobs, title)
+        return
+
+    from rich.table import Table
+    console = _console()
     table = Table(title=title, border_style="blue")
     
     table.add_column("Job ID", style="cyan", no_wrap=True)
@@ -158,17 +235,12 @@ def _print_job_table(jobs, title):
     table.add_column("Created At", style="default")
     table.add_column("Run At", style="yellow")
 
-    def format_state(state):
-        if state == 'completed': return "[green]completed[/green]"
-        if state == 'processing': return "[yellow]processing[/yellow]"
-        if state == 'failed': return "[orange]failed[/orange]"
-        if state == 'dead': return "[bold red]dead[/bold red]"
-        return "[dim]pending[/dim]"
-
+    state_markup = _STATE_MARKUP.get
+    pending = _STATE_MARKUP['pending']
     for job in jobs:
         table.add_row(
             job['id'],
-            format_state(job['state']),
+            state_markup(job['state'], pending),
             job['command'],
             f"{job['attempts']} / {job['max_retries']}",
             job['created_at'],
@@ -176,3 +248,31 @@ def _print_job_table(jobs, title):
         )
     
     console.print(table)
+
+def _write_plain_table(jobs, title):
+    """
+    Writes jobs as fixed-width plain text straight to stdout.
+    Rich measures every cell of every row before printing anything,
+    which dominates 'list' for large --limit values.
+    """
+    header = ("Job ID", "State", "Command", "Attempts", "Created At", "Run At")
+    rows = [header]
+    rows.extend(
+        (
+            job['id'],
+            job['state'],
+            job['command'],
+            f"{job['attempts']} / {job['max_retries']}",
+            job['created_at'],
+            job['run_at'] or "ASAP",
+        )
+        for job in jobs
+    )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+
+    out = sys.stdout
+    out.write(f"{title}\n")
+    out.writelines(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + "\n"
+        for row in rows
+    )
@@ -1,19 +1,61 @@
-import datetime
+import logging
+import os
 import random
 import math
 from.persistence import SQLiteJobRepository
 
+logger = logging.getLogger("queuectl.core")
+
+# How calculate_backoff randomises the base ^ attempts delay:
+#   proportional - delay * U(0.8, 1.2), i.e. +/- 20%
+#   full         - U(0, delay)
+#   decorrelated - U(base, 3 * previous delay), with the previous delay
+#                  taken as max(base, base ^ (attempts - 1))
+JITTER_STRATEGIES = ("proportional", "full", "decorrelated")
+
+# Upper bound on a retry delay. Far larger delays would push run_at past
+# year 9999, where SQLite's strftime() returns NULL, i.e. "run now".
+MAX_BACKOFF_SECONDS = 30 * 24 * 3600  # 30 days
+
 class WorkerConfig:
     """A simple container for worker configuration."""
-    def __init__(self, backoff_base=2):
+    def __init__(self, backoff_base=2, jitter="proportional"):
+        if jitter not in JITTER_STRATEGIES:
+            raise ValueError(f"Unknown jitter strategy: {jitter!r}")
         self.backoff_base = float(backoff_base)
+        self.jitter = jitter
+        self._rng = None
+        self._rng_pid = None
 
-def complete_job(repository: SQLiteJobRepository, job, stdout, stderr):
+    @property
+    def rng(self):
+        """
+        A random.Random private to the current process, seeded from
+        os.urandom. The config is created before the workers fork, so
+        the generator is re-created in each process; otherwise every
+        worker would produce the same "random" jitter.
+        """
+        pid = os.getpid()
+        if self._rng_pid != pid:
+            self._rng = random.Random(os.urandom(16))
+            self._rng_pid = pid
+        return self._rng
+
+def complete_job(repository: SQLiteJobRepository, job, stdout, stderr,
+                 stdout_truncated=False, stderr_truncated=False):
     """Marks a job as 'completed' and logs its output."""
-    print(f"Job {job['id']} completed successfully.")
-    repository.update_state(job['id'], 'completed', stdout=stdout, stderr=stderr)
+    logger.info("Job %s completed successfully.", job['id'])
+    repository.update_state(
+        job['id'], 
+        'completed', 
+        stdout=stdout, 
+        stderr=stderr,
+        stdout_truncated=stdout_truncated,
+        stderr_truncated=stderr_truncated,
+    )
 
-def fail_job(repository: SQLiteJobRepository, job, stderr, config: WorkerConfig):
+def fail_job(repository: SQLiteJobRepository, job, stderr, config: WorkerConfig,
+             stderr_truncated=False):
     """
     Handles a failed job.
     Increments attempt counter. If retries are exhausted, moves to DLQ ('dead').
@@ -22,44 +64,47 @@ def fail_job(repository: SQLiteJobRepository, job, stderr, config: WorkerConfig)
     """
     if job['attempts'] >= job['max_retries']:
         # Retries exhausted, move to Dead Letter Queue (DLQ)
-        print(f"Job {job['id']} failed. Max retries ({job['max_retries']}) reached. Moving to DLQ.")
-        repository.update_state(job['id'], 'dead', stderr=stderr)
+        logger.warning("Job %s failed. Max retries (%s) reached. Moving to DLQ.", job['id'], job['max_retries'])
+        repository.update_state(job['id'], 'dead', stderr=stderr, stderr_truncated=stderr_truncated)
     else:
         # Job is retryable.
         # Calculate exponential backoff and reschedule.
-        delay_seconds, next_run_at = calculate_backoff(job, config)
+        delay_seconds = calculate_backoff(job, config)
         
-        print(f"Job {job['id']} failed. Retrying in {delay_seconds:.2f}s...")
+        logger.warning("Job %s failed. Retrying in %.2fs...", job['id'], delay_seconds)
         
-        # Set state back to 'pending' but with a future 'run_at' time.
-        repository.update_state(
-            job['id'], 
-            'pending', 
-            stderr=stderr, 
-            run_at=next_run_at
-        )
+        # Set state back to 'pending' but with a future 'run_at' time
+        # (computed by SQLite in the same UPDATE).
+        repository.reschedule(job['id'], stderr, delay_seconds, stderr_truncated=stderr_truncated)
 
 def calculate_backoff(job, config: WorkerConfig):
     """
     Calculates the exponential backoff delay based on the user's formula.
-    Returns (delay_seconds, next_run_at_iso_string).
+    Returns the delay in seconds (with jitter applied), at most
+    MAX_BACKOFF_SECONDS.
     [83, 84, 85, 86, 87]
     """
     attempts = job['attempts']
     
     # Calculate delay: delay = base ^ attempts
-    delay_seconds = config.backoff_base ** attempts
+    base = config.backoff_base
+    delay_seconds = _capped_power(base, attempts)
     
-    # Add jitter (e.g., +/- 20%) to prevent thundering herd
-    jitter = random.uniform(0.8, 1.2)
-    delay_with_jitter = delay_seconds * jitter
-    
-    next_run_time = (
-        datetime.datetime.now(datetime.timezone.utc) + 
-        datetime.timedelta(seconds=delay_with_jitter)
-    )
-    
-    # Format for SQLite [29, 30, 31, 33]
-    next_run_at_iso = next_run_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Add jitter to prevent thundering herd
+    r = config.rng.random()
+    if config.jitter == "full":
+        delay_with_jitter = delay_seconds * r
+    elif config.jitter == "decorrelated":
+        previous = max(base, _capped_power(base, attempts - 1))  # Never below base
+        delay_with_jitter = base + (3 * previous - base) * r
+    else:
+        delay_with_jitter = delay_seconds * (0.8 + 0.4 * r)  # +/- 20%
     
-    return delay_with_jitter, next_run_at_iso
+    return min(delay_with_jitter, MAX_BACKOFF_SECONDS)
+
+def _capped_power(base, exponent):
+    """base ** exponent, but at most MAX_BACKOFF_SECONDS (and never OverflowError)."""
+    try:
+        return min(base ** exponent, MAX_BACKOFF_SECONDS)
+    except OverflowError:
+        return MAX_BACKOFF_SECONDS
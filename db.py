@@ -1,5 +1,7 @@
 import sqlite3
 import os
+import uuid
+from urllib.request import pathname2url
 
 # Use an environment variable for the DB path, default to 'queue.db'
 DB_PATH = os.environ.get("QUEUECTL_DB_PATH", "queue.db")
@@ -11,7 +13,11 @@ def get_connection():
     This connection is configured for robust multi-process concurrency
     by enabling Write-Ahead Log (WAL) mode.[13, 14, 15, 16, 17, 18, 19, 20, 21, 22]
     """
-    conn = sqlite3.connect(DB_PATH, timeout=10)  # 10-second timeout for lock contention
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=10,             # 10-second timeout for lock contention
+        cached_statements=256,  # Room for every statement in persistence.py
+    )
     conn.row_factory = sqlite3.Row  # Access columns by name
     
     # --- CRITICAL CONCURRENCY CONFIGURATION ---
@@ -23,14 +29,42 @@ def get_connection():
     # 2. Set Synchronous mode
     #    'NORMAL' is a safe and fast setting for WAL mode.
     conn.execute("PRAGMA synchronous = NORMAL;")
-    
+
+    # 3. Connection-level tuning. The connection is long-lived, so these
+    #    are paid for once per process.
+    conn.execute("PRAGMA cache_size = -20000;")      # ~20 MB page cache
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")    # 256 MB
+
+    # 4. Checkpoint the WAL less often from inside commits (workers
+    #    also checkpoint when they go idle), and truncate it back to
+    #    at most 64 MB afterwards.
+    conn.execute("PRAGMA wal_autocheckpoint = 10000;")
+    conn.execute("PRAGMA journal_size_limit = 67108864;")
+
     return conn
 
-def init_db():
-    """Initializes the database schema."""
-    schema = """
-    CREATE TABLE IF NOT EXISTS jobs (
-        id           TEXT PRIMARY KEY,
+def get_ro_connection():
+    """
+    Opens a read-only connection to the SQLite database.
+
+    Used for the CLI read paths ('list', 'show'). In WAL mode readers
+    never take the write lock, so these queries do not queue up behind
+    a worker's BEGIN IMMEDIATE in dequeue.
+    """
+    uri = f"file:{pathname2url(DB_PATH)}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=10, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+
+    conn.execute("PRAGMA query_only = 1;")
+    conn.execute("PRAGMA read_uncommitted = 1;")
+
+    return conn
+
+# Column definitions shared by 'jobs' and 'jobs_archive', so that
+# 'INSERT INTO jobs_archive SELECT * FROM jobs' lines up.
+JOB_COLUMNS = """
+        id           BLOB PRIMARY KEY,  -- 16-byte UUID (uuid.UUID.bytes)
         command      TEXT NOT NULL,
         state        TEXT NOT NULL CHECK(state IN ('pending', 'processing', 'completed', 'failed', 'dead')),
         attempts     INTEGER NOT NULL DEFAULT 0,
@@ -42,15 +76,78 @@ def init_db():
         priority     INTEGER NOT NULL DEFAULT 0,
         run_at       TEXT DEFAULT NULL,
         stdout       TEXT DEFAULT NULL,
-        stderr       TEXT DEFAULT NULL
-    );
+        stderr       TEXT DEFAULT NULL,
 
-    CREATE INDEX IF NOT EXISTS idx_jobs_state_priority_created_at
-    ON jobs (state, priority, created_at);
-    
+        -- 1 when stdout/stderr hold only the tail of the job's output
+        stdout_truncated INTEGER NOT NULL DEFAULT 0,
+        stderr_truncated INTEGER NOT NULL DEFAULT 0
+"""
+
+# Columns added after the first release, as (name, definition). init_db
+# appends any that are missing to existing tables, in this order.
+ADDED_JOB_COLUMNS = [
+    ("stdout_truncated", "INTEGER NOT NULL DEFAULT 0"),
+    ("stderr_truncated", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+def _migrate_text_ids(conn, table):
+    """
+    Rebuilds `table` with 16-byte BLOB IDs if it still has the TEXT
+    (hyphenated UUID) IDs of the first release. SQLite cannot change a
+    column's type in place, so the rows are copied into a new table.
+    """
+    types = {row["name"]: row["type"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if types["id"].upper() != "TEXT":
+        return
+    columns = list(types)
+
+    conn.create_function("uuid_bytes", 1, lambda s: uuid.UUID(s).bytes, deterministic=True)
+    names = ", ".join(columns)
+    values = ", ".join("uuid_bytes(id)" if name == "id" else name for name in columns)
+    conn.execute(f"CREATE TABLE {table}_migrating ({JOB_COLUMNS})")
+    conn.execute(f"INSERT INTO {table}_migrating ({names}) SELECT {values} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_migrating RENAME TO {table}")
+
+def init_db():
+    """Initializes the database schema, migrating an existing one."""
+    tables = f"""
+    CREATE TABLE IF NOT EXISTS jobs ({JOB_COLUMNS});
+
+    -- Old completed/dead jobs are moved here by 'queuectl archive',
+    -- keeping 'jobs' (and its indexes) small.
+    CREATE TABLE IF NOT EXISTS jobs_archive ({JOB_COLUMNS});
+    """
+    # Created after the migrations, since rebuilding 'jobs' drops its indexes.
+    indexes = """
     CREATE INDEX IF NOT EXISTS idx_jobs_state_run_at
     ON jobs (state, run_at);
+
+    -- Partial index for dequeue: only 'pending' rows, in the exact
+    -- order dequeue picks them, so completed/dead rows piling up in
+    -- the table never enter the hot path.
+    CREATE INDEX IF NOT EXISTS idx_pending_ready
+    ON jobs (priority DESC, created_at ASC, run_at)
+    WHERE state = 'pending';
+
+    -- Serves 'list' (WHERE state = ? ORDER BY created_at) for every
+    -- state, including 'list --dlq', without a temporary sort.
+    CREATE INDEX IF NOT EXISTS idx_jobs_state_created_at
+    ON jobs (state, created_at);
+
+    -- Superseded by idx_pending_ready (its ascending priority column
+    -- forced a sort for dequeue's 'priority DESC').
+    DROP INDEX IF EXISTS idx_jobs_state_priority_created_at;
     """
     with get_connection() as conn:
-        conn.executescript(schema)
+        conn.executescript(tables)
+        conn.execute('BEGIN IMMEDIATE TRANSACTION')
+        for table in ("jobs", "jobs_archive"):
+            _migrate_text_ids(conn, table)
+            existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, definition in ADDED_JOB_COLUMNS:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        conn.commit()
+        conn.executescript(indexes)
         conn.commit()
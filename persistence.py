@@ -1,12 +1,141 @@
+import logging
 import sqlite3
 import uuid
-import datetime
-from.db import get_connection
+from.db import get_connection, get_ro_connection
 
-def get_iso_now():
-    """Returns the current time in ISO 8601 UTC format (with 'Z')."""
-    # [29, 30, 31, 32, 33]
-    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+logger = logging.getLogger("queuectl.persistence")
+
+# All timestamps are computed by SQLite itself, in ISO 8601 UTC format
+# (with 'Z'): strftime('%Y-%m-%dT%H:%M:%SZ', 'now') [29, 30, 31, 32, 33]
+
+# --- SQL statements ---
+# Module-level constants, so every call passes the same string and the
+# connection's statement cache hands back the prepared statement.
+
+_SQL_ADD = """
+INSERT INTO jobs (id, command, state, max_retries, priority, run_at, created_at, updated_at)
+VALUES (?,?, 'pending',?,?,?,
+        strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+        strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+"""
+
+_SQL_GET = "SELECT * FROM jobs WHERE id =?"
+
+_SQL_LIST_JOBS = "SELECT * FROM jobs WHERE state =? ORDER BY created_at ASC LIMIT?"
+
+_SQL_UPDATE_STATE = """
+UPDATE jobs
+SET state =?,
+    updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+    stdout = COALESCE(?, stdout),
+    stderr = COALESCE(?, stderr),
+    stdout_truncated = COALESCE(?, stdout_truncated),
+    stderr_truncated = COALESCE(?, stderr_truncated),
+    run_at =?
+WHERE id =?
+"""
+
+_SQL_RESCHEDULE = """
+UPDATE jobs
+SET state = 'pending',
+    updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+    stderr = COALESCE(?, stderr),
+    stderr_truncated = COALESCE(?, stderr_truncated),
+    run_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now', '+' || ? || ' seconds')
+WHERE id =?
+"""
+
+_SQL_REQUEUE = """
+UPDATE jobs
+SET state = 'pending',
+    attempts = 0,
+    updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+    run_at = NULL,
+    stdout = NULL,
+    stderr = NULL,
+    stdout_truncated = 0,
+    stderr_truncated = 0
+WHERE id =? AND state = 'dead'
+RETURNING id
+"""
+
+# This "Golden Query" performs the find, update, and return
+# in a single, atomic operation, which is the key to
+# concurrency-safe queuing in SQLite.
+#
+# The scalar subquery is deliberate. 'UPDATE jobs ... FROM (SELECT id
+# ... LIMIT 1) WHERE jobs.id = picked.id' (UPDATE FROM) plans as a
+# materialised subquery plus the same primary-key probe, and measured
+# slower, not faster.
+_SQL_DEQUEUE = """
+UPDATE jobs
+SET state = 'processing',
+    updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+    attempts = attempts + 1
+WHERE id = (
+    -- Pinned to the partial index: without ANALYZE statistics
+    -- the planner would pick a full (state, ...) index instead.
+    SELECT id FROM jobs INDEXED BY idx_pending_ready
+    WHERE
+        state = 'pending'
+        -- (Bonus) Handle scheduled jobs [61, 62, 54, 63, 64, 65, 66]
+        AND (run_at IS NULL OR run_at <= strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+    ORDER BY
+        priority DESC,  -- (Bonus) Highest priority first [66, 67, 68, 69]
+        created_at ASC  -- FIFO within priority
+    LIMIT 1             -- Get only one job [42, 43]
+)
+RETURNING *;  -- Return the locked job to the caller [40, 45, 47]
+"""
+
+_SQL_ARCHIVE_CUTOFF = "SELECT strftime('%Y-%m-%dT%H:%M:%SZ', 'now', '-' || ? || ' days')"
+
+_SQL_ARCHIVE_COPY = """
+INSERT INTO jobs_archive
+SELECT * FROM jobs WHERE state IN ('completed', 'dead') AND updated_at <?
+"""
+
+_SQL_ARCHIVE_DELETE = """
+DELETE FROM jobs WHERE state IN ('completed', 'dead') AND updated_at <?
+"""
+
+_SQL_SECONDS_UNTIL_NEXT_RUN = """
+SELECT (julianday(MIN(run_at)) - julianday('now')) * 86400.0
+FROM jobs
+WHERE state = 'pending'
+  AND run_at > strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+"""
+
+def _id_bytes(job_id):
+    """
+    Converts a job ID to its stored form (the 16 raw UUID bytes).
+    Accepts the hyphenated string form or raw bytes; raises
+    ValueError for anything that is not a UUID.
+    """
+    if isinstance(job_id, bytes):
+        return job_id
+    return uuid.UUID(job_id).bytes
+
+def _fmt_id(b):
+    """Converts a stored job ID back to its hyphenated string form."""
+    return str(uuid.UUID(bytes=b))
+
+def _is_contention(e):
+    """
+    True if an sqlite3.OperationalError means another connection holds
+    a lock (SQLITE_BUSY / SQLITE_LOCKED), rather than e.g. a schema error.
+    """
+    code = getattr(e, "sqlite_errorcode", None)  # Python 3.11+
+    if code is not None:
+        return (code & 0xFF) in (5, 6)  # SQLITE_BUSY, SQLITE_LOCKED (and extended codes)
+    message = str(e)
+    return "locked" in message or "busy" in message
+
+def _job_from_row(row):
+    """Converts a 'jobs' row to a dict, with the ID in string form."""
+    job = dict(row)
+    job['id'] = _fmt_id(job['id'])
+    return job
 
 class SQLiteJobRepository:
     """
@@ -14,68 +143,102 @@ class SQLiteJobRepository:
     all database logic is centralized in this one file.
     """
 
+    def __init__(self):
+        # One connection per repository (and so per process), opened on
+        # first use. Workers create their repository inside the child
+        # process, so the connection is never shared across a fork.
+        # Mutators go through the single read-write connection; 'get'
+        # and 'list_jobs' use a separate read-only one.
+        self._conn = None
+        self._ro_conn = None
+
+    @property
+    def _c(self):
+        """The cached read-write connection, opened (and configured) lazily."""
+        if self._conn is None:
+            self._conn = get_connection()
+        return self._conn
+
+    @property
+    def _ro(self):
+        """The cached read-only connection, opened lazily."""
+        if self._ro_conn is None:
+            self._ro_conn = get_ro_connection()
+        return self._ro_conn
+
     def add(self, command, max_retries, priority, run_at):
         """Adds a new job to the queue in a 'pending' state."""
-        job_id = str(uuid.uuid4())
-        now = get_iso_now()
-        
-        sql = """
-        INSERT INTO jobs (id, command, state, max_retries, priority, run_at, created_at, updated_at)
-        VALUES (?,?, 'pending',?,?,?,?,?)
-        """
-        
-        with get_connection() as conn:
-            conn.execute(sql, [job_id, command, max_retries, priority, run_at, now, now])
+        job_id = uuid.uuid4()
+        with self._c as conn:  # Commits, or rolls back on error
+            conn.execute(_SQL_ADD, [job_id.bytes, command, max_retries, priority, run_at])
+        return str(job_id)
+
+    def add_many(self, jobs):
+        """
+        Adds several jobs in a single transaction (one commit/fsync).
+
+        `jobs` is a sequence of (command, max_retries, priority, run_at)
+        tuples. Returns the new job IDs, in the same order.
+        """
+        rows = [
+            [uuid.uuid4().bytes, command, max_retries, priority, run_at]
+            for command, max_retries, priority, run_at in jobs
+        ]
+
+        conn = self._c
+        conn.execute('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            conn.executemany(_SQL_ADD, rows)
             conn.commit()
-        return job_id
+        except Exception:
+            conn.rollback()
+            raise
+        return [_fmt_id(row[0]) for row in rows]
 
     def get(self, job_id):
         """Fetches a single job by its ID."""
-        with get_connection() as conn:
-            cursor = conn.execute("SELECT * FROM jobs WHERE id =?", [job_id])
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        try:
+            job_id = _id_bytes(job_id)
+        except ValueError:
+            return None  # Not a UUID, so cannot match any job
+        cursor = self._ro.execute(_SQL_GET, [job_id])
+        row = cursor.fetchone()
+        return _job_from_row(row) if row else None
 
     def list_jobs(self, state, limit):
         """Lists all jobs in a given state, ordered by creation time."""
-        sql = "SELECT * FROM jobs WHERE state =? ORDER BY created_at ASC LIMIT?"
-        with get_connection() as conn:
-            cursor = conn.execute(sql, [state, limit])
-            return [dict(row) for row in cursor.fetchall()]
-
-    def update_state(self, job_id, state, stdout=None, stderr=None, run_at=None):
-        """Updates the state and output of a job."""
-        now = get_iso_now()
-        sql = """
-        UPDATE jobs
-        SET state =?,
-            updated_at =?,
-            stdout = COALESCE(?, stdout),
-            stderr = COALESCE(?, stderr),
-            run_at =?
-        WHERE id =?
-        """
-        with get_connection() as conn:
-            conn.execute(sql, [state, now, stdout, stderr, run_at, job_id])
-            conn.commit()
+        cursor = self._ro.execute(_SQL_LIST_JOBS, [state, limit])
+        return [_job_from_row(row) for row in cursor.fetchall()]
+
+    def update_state(self, job_id, state, stdout=None, stderr=None, run_at=None,
+                     stdout_truncated=None, stderr_truncated=None):
+        """
+        Updates the state and output of a job. Output (and its
+        *_truncated flag) left as None keeps the stored value.
+        """
+        with self._c as conn:
+            conn.execute(_SQL_UPDATE_STATE, [
+                state, stdout, stderr, stdout_truncated, stderr_truncated, run_at, _id_bytes(job_id)
+            ])
+
+    def reschedule(self, job_id, stderr, delay_seconds, stderr_truncated=None):
+        """
+        Puts a failed job back to 'pending', to run again `delay_seconds`
+        from now. The run_at timestamp is computed inside the UPDATE.
+        """
+        with self._c as conn:
+            conn.execute(_SQL_RESCHEDULE, [stderr, stderr_truncated, delay_seconds, _id_bytes(job_id)])
 
     def requeue(self, job_id):
         """Moves a 'dead' job back to the 'pending' state."""
-        now = get_iso_now()
-        sql = """
-        UPDATE jobs
-        SET state = 'pending',
-            attempts = 0,
-            updated_at =?,
-            run_at = NULL,
-            stdout = NULL,
-            stderr = NULL
-        WHERE id =? AND state = 'dead'
-        """
-        with get_connection() as conn:
-            cursor = conn.execute(sql, [now, job_id])
-            conn.commit()
-            return cursor.rowcount > 0  # True if update was successful
+        try:
+            job_id = _id_bytes(job_id)
+        except ValueError:
+            return False  # Not a UUID, so cannot match any job
+        with self._c as conn:
+            cursor = conn.execute(_SQL_REQUEUE, [job_id])
+            row = cursor.fetchone()
+        return row is not None  # True if update was successful
 
     def dequeue(self):
         """
@@ -83,47 +246,85 @@ class SQLiteJobRepository:
         updates its state to 'processing', and returns it.
         This prevents race conditions.[34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60]
         """
-        
-        # This "Golden Query" performs the find, update, and return
-        # in a single, atomic operation, which is the key to
-        # concurrency-safe queuing in SQLite.
-        sql = f"""
-        UPDATE jobs
-        SET state = 'processing',
-            updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
-            attempts = attempts + 1
-        WHERE id = (
-            SELECT id FROM jobs
-            WHERE 
-                state = 'pending'
-                -- (Bonus) Handle scheduled jobs [61, 62, 54, 63, 64, 65, 66]
-                AND (run_at IS NULL OR run_at <= strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
-            ORDER BY
-                priority DESC,  -- (Bonus) Highest priority first [66, 67, 68, 69]
-                created_at ASC  -- FIFO within priority
-            LIMIT 1             -- Get only one job [42, 43]
-        )
-        RETURNING *;  -- Return the locked job to the caller [40, 45, 47]
-        """
-        
         try:
-            with get_connection() as conn:
-                # BEGIN IMMEDIATE acquires a write lock immediately
-                # to prevent deadlocks from lock-upgrade contention.[70]
-                conn.execute('BEGIN IMMEDIATE TRANSACTION')
-                try:
-                    cursor = conn.execute(sql)
-                    job_row = cursor.fetchone()
-                    conn.commit()
-                    
-                    if job_row:
-                        return dict(job_row)
-                    return None  # Queue was empty
-                except Exception:
-                    conn.rollback()
-                    raise
+            conn = self._c
+            # BEGIN IMMEDIATE acquires a write lock immediately
+            # to prevent deadlocks from lock-upgrade contention.[70]
+            conn.execute('BEGIN IMMEDIATE TRANSACTION')
+            try:
+                cursor = conn.execute(_SQL_DEQUEUE)
+                job_row = cursor.fetchone()
+                # Convert before committing, so a row that cannot be
+                # read rolls back instead of staying in 'processing'.
+                job = _job_from_row(job_row) if job_row else None
+                conn.commit()
+                return job  # None if the queue was empty
+            except Exception:
+                conn.rollback()
+                raise
         except sqlite3.OperationalError as e:
             # This can happen under high contention ("database is locked")
-            # The worker will simply retry the dequeue.
-            print(f"Dequeue failed due to contention: {e}")
+            # The worker will simply retry the dequeue. Anything else
+            # (e.g. "no such index" on a database not re-initialised
+            # with 'queuectl initdb') is raised.
+            if not _is_contention(e):
+                raise
+            logger.warning("Dequeue failed due to contention: %s", e)
             return None
+
+    def archive_old(self, cutoff_days):
+        """
+        Moves 'completed' and 'dead' jobs last updated more than
+        `cutoff_days` days ago from 'jobs' to 'jobs_archive', in one
+        transaction. Returns the number of jobs archived.
+        """
+        conn = self._c
+        conn.execute('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            # Fix the cutoff once, so both statements see the same rows.
+            cutoff = conn.execute(_SQL_ARCHIVE_CUTOFF, [cutoff_days]).fetchone()[0]
+            conn.execute(_SQL_ARCHIVE_COPY, [cutoff])
+            cursor = conn.execute(_SQL_ARCHIVE_DELETE, [cutoff])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return cursor.rowcount
+
+    def data_version(self):
+        """
+        Returns SQLite's data_version counter, which changes whenever
+        another connection commits to the database. Reading it takes
+        no lock, so it is a cheap way to detect that new work may exist.
+        """
+        return self._c.execute("PRAGMA data_version;").fetchone()[0]
+
+    def seconds_until_next_run(self):
+        """
+        Returns the number of seconds until the earliest scheduled
+        pending job becomes ready, or None if no job is scheduled.
+        """
+        return self._c.execute(_SQL_SECONDS_UNTIL_NEXT_RUN).fetchone()[0]
+
+    def checkpoint(self):
+        """
+        Runs a PASSIVE WAL checkpoint: copies as much of the WAL back
+        into the database as possible without waiting on any reader or
+        writer.
+        """
+        self._c.execute("PRAGMA wal_checkpoint(PASSIVE);")
+
+    def optimize(self):
+        """
+        Runs 'PRAGMA optimize' so the query planner's statistics keep up
+        with the table as it grows. Cheap when there is nothing to do.
+        """
+        self._c.execute("PRAGMA optimize;")
+
+    def close(self):
+        """Closes any open connections held by this repository."""
+        for conn in (self._conn, self._ro_conn):
+            if conn is not None:
+                conn.close()
+        self._conn = None
+        self._ro_conn = None
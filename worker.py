@@ -1,25 +1,148 @@
+import concurrent.futures
+import logging
+import logging.handlers
 import multiprocessing
+import os
+import select
+import selectors
 import signal
 import time
 import subprocess
+import sqlite3
+import sys
 from. import core
 from.persistence import SQLiteJobRepository
 from.core import WorkerConfig
 
+logger = logging.getLogger("queuectl.worker")
+
+# Run 'PRAGMA optimize' about every this many seconds (an idle wait
+# can delay it by up to MAX_IDLE_WAIT_SECONDS), in addition to once
+# at shutdown.
+OPTIMIZE_INTERVAL_SECONDS = 3600
+
+# Upper bound on how long an idle worker waits before trying to
+# dequeue again, even if nothing appears to have changed.
+MAX_IDLE_WAIT_SECONDS = 60
+
+# (Bonus Feature) Job timeout [103, 113, 114, 115, 116]
+JOB_TIMEOUT_SECONDS = 60  # This should be configurable
+
+# Only the last this-many bytes of each of a job's stdout and stderr
+# are kept, bounding worker memory and the size of stored output.
+OUTPUT_TAIL_BYTES = 64 * 1024
+
+def _run_shell(command, timeout):
+    """
+    Runs `command` through /bin/sh, as required by user spec
+    (e.g., "echo 'Hello'"), and returns
+    (returncode, stdout, stderr, stdout_truncated, stderr_truncated).
+
+    The shell is started with os.posix_spawn, which on Linux uses
+    vfork/CLONE_VM instead of copying the worker's page tables, and its
+    output is collected from two pipes in a single select loop. Only the
+    last OUTPUT_TAIL_BYTES of each stream are kept; the *_truncated
+    flags say whether anything was dropped.
+    Raises subprocess.TimeoutExpired, after killing the shell, if the
+    command runs longer than `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    try:
+        try:
+            pid = os.posix_spawn(
+                "/bin/sh",
+                ["sh", "-c", command],
+                os.environ,
+                file_actions=[
+                    (os.POSIX_SPAWN_DUP2, out_w, 1),
+                    (os.POSIX_SPAWN_DUP2, err_w, 2),
+                ],
+                # Python ignores SIGPIPE; give the job the default
+                # dispositions, as subprocess does.
+                setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+            )
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+
+        output = {out_r: bytearray(), err_r: bytearray()}
+        truncated = {out_r: False, err_r: False}
+        with selectors.DefaultSelector() as selector:
+            selector.register(out_r, selectors.EVENT_READ)
+            selector.register(err_r, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    _kill(pid)
+                    raise subprocess.TimeoutExpired(command, timeout)
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        tail = output[key.fd]
+                        tail += data
+                        if len(tail) > OUTPUT_TAIL_BYTES:
+                            del tail[:-OUTPUT_TAIL_BYTES]
+                            truncated[key.fd] = True
+                    else:
+                        selector.unregister(key.fd)  # EOF
+    finally:
+        os.close(out_r)
+        os.close(err_r)
+
+    # Both pipes are closed, so the shell is normally exiting already;
+    # reap it with a short backoff, still honouring the deadline.
+    delay = 0.0001
+    while True:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid:
+            break
+        if time.monotonic() >= deadline:
+            _kill(pid)
+            raise subprocess.TimeoutExpired(command, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)  # Same convention as subprocess
+    else:
+        returncode = os.WEXITSTATUS(status)
+
+    stdout = output[out_r].decode(errors="replace")
+    stderr = output[err_r].decode(errors="replace")
+    return returncode, stdout, stderr, truncated[out_r], truncated[err_r]
+
+def _kill(pid):
+    """Kills and reaps a child process."""
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
 class Worker(multiprocessing.Process):
     """
     A worker process that inherits from multiprocessing.Process.
     This provides full control over its lifecycle and signal handling.
     [88, 89, 90, 91, 92, 93, 94, 95, 96, 97]
+
+    Up to `concurrency` job commands run at once: each one is
+    supervised by a thread from a small pool, while all database work
+    stays on the main thread, which owns the SQLite connection.
     """
 
-    def __init__(self, config: WorkerConfig, poll_interval=1):
+    def __init__(self, config: WorkerConfig, poll_interval=1, concurrency=1,
+                 log_queue=None, log_level=logging.WARNING):
         super().__init__()
         self.config = config
         self.poll_interval = poll_interval
+        self.concurrency = concurrency
+        self.log_queue = log_queue  # Records go to the parent's QueueListener
+        self.log_level = log_level
         self.repository = None  # To be initialized in the new process
-        self.shutdown_flag = multiprocessing.Event()
-        self.current_job_id = None
+        # Plain attributes, touched only by this process's main thread
+        # and its signal handler: no lock in the poll loop.
+        self.shutdown_requested = False
+        self._wakeup_fd = None  # Read end of the signal wakeup pipe
+        self.current_jobs = {}  # Future -> job, for commands in flight
 
     def run(self):
         """The main loop of the worker process."""
@@ -27,75 +150,184 @@ class Worker(multiprocessing.Process):
         # 1. Initialize DB connection *in this process*.
         #    (SQLite connections cannot be shared across processes)
         self.repository = SQLiteJobRepository()
+        self._configure_logging()
 
         # 2. Install signal handlers for graceful shutdown [98, 99, 100, 101, 102]
         #    This worker process will now ignore SIGINT and handle
-        #    it via the shutdown_flag.
+        #    it via shutdown_requested. Python also writes each signal's
+        #    number to the wakeup pipe, so a sleeping worker wakes at once.
+        self._wakeup_fd, wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_fd, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
         signal.signal(signal.SIGINT, self._handle_shutdown)
         signal.signal(signal.SIGTERM, self._handle_shutdown)
 
-        print(f"Worker {self.pid} starting...")
+        logger.info("Worker %s starting...", self.pid)
         
-        while not self.shutdown_flag.is_set():
-            job = None
-            try:
-                job = self.repository.dequeue()
-                if job:
-                    self.current_job_id = job['id']
-                    print(f"Worker {self.pid}: Processing job {job['id']}")
-                    self.process_job(job)
-                    self.current_job_id = None
-                else:
-                    # No jobs found, sleep to prevent busy-looping [35]
-                    time.sleep(self.poll_interval)
-            
-            except Exception as e:
-                # Top-level exception handler
-                print(f"Worker {self.pid}: Unhandled exception: {e}")
-                if job:
-                    # If we crashed while processing, mark it as failed.
-                    core.fail_job(self.repository, job, str(e), self.config)
+        next_optimize = time.monotonic() + OPTIMIZE_INTERVAL_SECONDS
+        checkpoint_pending = False  # Jobs recorded since the last checkpoint
+        shutdown_logged = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            # After a shutdown signal, stop dequeuing but let the
+            # commands already in flight finish.
+            while not self.shutdown_requested or self.current_jobs:
+                if self.shutdown_requested and not shutdown_logged:
+                    # Logged here rather than in the signal handler,
+                    # which must not take the logging locks.
+                    logger.info("Worker %s: Shutdown signal received...", self.pid)
+                    shutdown_logged = True
+
+                job = None
+                version = None  # data_version before the last dequeue
+                try:
+                    if time.monotonic() >= next_optimize:
+                        next_optimize = time.monotonic() + OPTIMIZE_INTERVAL_SECONDS
+                        self.repository.optimize()
+
+                    # Fill any free slots.
+                    while (len(self.current_jobs) < self.concurrency
+                           and not self.shutdown_requested):
+                        # Read before dequeuing: a commit from another
+                        # process after this point changes the version,
+                        # so an empty dequeue cannot miss it.
+                        version = self.repository.data_version()
+                        job = self.repository.dequeue()
+                        if not job:
+                            break
+                        logger.info("Worker %s: Processing job %s", self.pid, job['id'])
+                        future = pool.submit(_run_shell, job['command'], JOB_TIMEOUT_SECONDS)
+                        self.current_jobs[future] = job
+                    job = None
+
+                    if self.current_jobs:
+                        done, _ = concurrent.futures.wait(
+                            self.current_jobs,
+                            timeout=self.poll_interval,
+                            return_when=concurrent.futures.FIRST_COMPLETED,
+                        )
+                        for future in done:
+                            job = self.current_jobs.pop(future)
+                            self.process_job(job, future)
+                            checkpoint_pending = True
+                        job = None
+                    else:
+                        # Going idle is the cheapest moment to move this
+                        # worker's writes out of the WAL, rather than
+                        # leaving it to an autocheckpoint mid-burst.
+                        if checkpoint_pending:
+                            self.repository.checkpoint()
+                            checkpoint_pending = False
+
+                        # No jobs found, wait for new work instead of
+                        # busy-looping [35]
+                        self._wait_for_work(version)
+                
+                except Exception as e:
+                    # Top-level exception handler
+                    logger.error("Worker %s: Unhandled exception: %s", self.pid, e)
+                    if job:
+                        # If we crashed while processing, mark it as failed.
+                        core.fail_job(self.repository, job, str(e), self.config)
+                    elif not self.current_jobs:
+                        # E.g. a schema error from dequeue: retry once per
+                        # poll_interval rather than in a tight loop.
+                        self._sleep(self.poll_interval)
         
-        print(f"Worker {self.pid} shutting down gracefully.")
+        try:
+            self.repository.optimize()
+        except sqlite3.Error as e:
+            # Workers stopping together all run ANALYZE at once; the
+            # losers get "database is locked" straight away (busy_timeout
+            # does not apply to a read that upgrades to a write).
+            logger.warning("Worker %s: PRAGMA optimize skipped: %s", self.pid, e)
+        finally:
+            self.repository.close()
+            signal.set_wakeup_fd(-1)
+            os.close(wakeup_w)
+            os.close(self._wakeup_fd)
+        logger.info("Worker %s shutting down gracefully.", self.pid)
+
+    def _configure_logging(self):
+        """
+        Routes the 'queuectl' loggers of this process to the parent's
+        log queue (or straight to stdout when there is none), so N
+        workers do not contend for the terminal on every job.
+        """
+        package_logger = logging.getLogger("queuectl")
+        package_logger.setLevel(self.log_level)
+        package_logger.propagate = False
+        package_logger.handlers.clear()  # Inherited from the parent on fork
+        if self.log_queue is not None:
+            package_logger.addHandler(logging.handlers.QueueHandler(self.log_queue))
+        else:
+            package_logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    def _wait_for_work(self, version):
+        """
+        Sleeps until a job may be ready to dequeue: another process has
+        committed a change (e.g. 'queuectl add') since data_version was
+        `version`, or the next scheduled job's run_at has arrived.
+
+        Only the lock-free data_version counter is checked every
+        poll_interval, so idle workers do not take the write lock that
+        dequeue needs.
+        """
+        delay = self.repository.seconds_until_next_run()
+        if delay is None or delay > MAX_IDLE_WAIT_SECONDS:
+            delay = MAX_IDLE_WAIT_SECONDS
+        deadline = time.monotonic() + delay
+
+        while not self.shutdown_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._sleep(min(self.poll_interval, remaining))
+            if self.repository.data_version() != version:
+                return
+
+    def _sleep(self, timeout):
+        """
+        Sleeps for up to `timeout` seconds, returning as soon as a
+        signal arrives (its number is written to the wakeup pipe).
+        """
+        readable, _, _ = select.select([self._wakeup_fd], [], [], timeout)
+        if readable:
+            os.read(self._wakeup_fd, 512)  # Drain the signal numbers
 
     def _handle_shutdown(self, sig, frame):
         """Signal handler to initiate graceful shutdown."""
-        print(f"Worker {self.pid}: Shutdown signal received...")
-        self.shutdown_flag.set()
+        # Only sets a flag: the wakeup pipe interrupts any sleep, and
+        # the main loop does the logging.
+        self.shutdown_requested = True
         # If we are busy with a job, the main loop will exit
         # *after* the job is done.
 
-    def process_job(self, job):
-        """Executes the job command in a subprocess."""
-        
-        # (Bonus Feature) Job timeout
-        JOB_TIMEOUT_SECONDS = 60  # This should be configurable
+    def process_job(self, job, future):
+        """Records the outcome of a job whose command has finished running."""
         
         try:
-            # subprocess.run is the modern, blocking call [103, 104, 105, 106]
-            result = subprocess.run(
-                job['command'],
-                shell=True,          # As required by user spec (e.g., "echo 'Hello'")
-                capture_output=True, # Captures stdout/stderr [107, 108, 109, 110, 111, 112]
-                text=True,           # Decodes stdout/stderr as strings
-                timeout=JOB_TIMEOUT_SECONDS # (Bonus) [103, 113, 114, 115, 116]
-            )
+            # Re-raises anything _run_shell raised in the pool thread
+            returncode, stdout, stderr, stdout_truncated, stderr_truncated = future.result()
             
             # Job finished successfully
-            if result.returncode == 0:
+            if returncode == 0:
                 core.complete_job(
                     self.repository, 
                     job, 
-                    result.stdout, 
-                    result.stderr
+                    stdout, 
+                    stderr,
+                    stdout_truncated=stdout_truncated,
+                    stderr_truncated=stderr_truncated,
                 )
             # Job failed with a non-zero exit code
             else:
                 core.fail_job(
                     self.repository, 
                     job, 
-                    result.stderr or "Job failed with non-zero exit code", 
-                    self.config
+                    stderr or "Job failed with non-zero exit code", 
+                    self.config,
+                    stderr_truncated=stderr_truncated,
                 )
         
         # (Bonus) Job exceeded its timeout [113, 114]